@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 #
 # This is a free software: you can redistribute it and/or modify
@@ -20,12 +20,31 @@
 # https://api.cloudflare.com/#account-load-balancer-pools-properties
 
 
-import json
-import urllib2
 import os
 import itertools
-
-from ansible.module_utils.basic import AnsibleModule
+import random
+import time
+
+from ansible.module_utils.basic import AnsibleModule, missing_required_lib
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+    HAS_REQUESTS = True
+except ImportError:
+    HAS_REQUESTS = False
+
+try:
+    import orjson
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:
+    import json
+    json_loads = json.loads
+
+    def json_dumps(obj):
+        # Match orjson: compact output, already encoded for the request body
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
 
 DOCUMENTATION = '''
 ---
@@ -35,6 +54,8 @@ description:
   - This module de-registers or registers an instance from pre defined pools
   - Will be marked changed when called only if a existing pool and account is matched
 author: Beat beat.no
+requirements:
+  - requests
 options:
   account_id:
     description: Identifier of the load balancer account
@@ -57,18 +78,50 @@ options:
     choices: ['present', 'absent']
     required: true
   instance_ip
-    description: IP of instance
-    required: true
+    description: IP of instance, required unless instances is given
+    required: false
   instance_name:
-    description: Name of instance
-    required: true
+    description: Name of instance, required unless instances is given
+    required: false
   instances_weight:
     description: Weight attributed to an instance
     required: false
   wait:
-    description: Wait for instance registration or deregistration to complete successfully before returning.
+    description:
+      - Wait for instance registration or deregistration to complete successfully before returning.
+      - The pool is polled with increasing delays for up to 30 seconds.
     choices: ['true', 'false']
     required: false
+  max_retries:
+    description:
+      - Number of attempts made for a request that is rate limited (429) or hits a transient server error (5xx).
+      - Honors the Retry-After header, otherwise backs off exponentially up to 30 seconds between attempts.
+    required: false
+    default: 4
+  cache_ttl:
+    description:
+      - Seconds a fetched pool is reused by later tasks running in the same process.
+      - Once expired the pool is revalidated with a conditional GET using its ETag.
+      - Set to 0 to always revalidate the pool.
+    required: false
+    default: 5
+  instances:
+    description:
+      - List of instances to register or deregister with a single pool update.
+      - Mutually exclusive with instance_ip and instance_name.
+    required: false
+    type: list
+    elements: dict
+    suboptions:
+      ip:
+        description: IP of instance
+        required: true
+      name:
+        description: Name of instance, required when state is present
+        required: false
+      weight:
+        description: Weight attributed to the instance, defaults to instance_weight
+        required: false
 '''
 
 EXAMPLES = '''
@@ -80,6 +133,19 @@ EXAMPLES = '''
     instance_ip="0.0.0.0"
     instance_name=example_server42
     instance_weight=1.0
+
+- cloudflare_account_instance:
+    account_id: 321423423gfd239sfda9afd0123e20
+    email: joe@example.com
+    api_key: 77a54a4c36858cfc10321fcfce22378e19e20
+    pool_id: 320fd09sa09fdsa98a09sfd098saf
+    state: present
+    instances:
+      - ip: 10.0.0.1
+        name: example_server1
+      - ip: 10.0.0.2
+        name: example_server2
+        weight: 0.5
 '''
 
 
@@ -113,12 +179,31 @@ RETURN = '''
    ]
 '''
 
+# Shared across Cloudflare instances so consecutive calls reuse one TLS connection
+_SESSION = None
+if HAS_REQUESTS:
+    _SESSION = requests.Session()
+    _SESSION.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=0))
+
+MAX_RETRY_DELAY = 30
+
+# Seconds slept between polls of the pool when wait is set, and the overall deadline
+WAIT_DELAYS = (0.5, 1, 2, 4, 8, 8, 8)
+WAIT_TIMEOUT = 30
+
+# Server assigned pool fields that cloudflare rejects on PUT
+READ_ONLY_POOL_FIELDS = ('id', 'created_on', 'modified_on')
+
+# Pool responses keyed by (url, api_key), each entry is (expires_ts, etag, body)
+_POOL_CACHE = {}
+
 class CloudflareException(Exception):
     pass
 
 class Cloudflare(object):
     def __init__(self, email, api_key, account_id, pool_id,
-                 state, instance_ip, instance_name, instance_weight, wait):
+                 state, instance_ip, instance_name, instance_weight, wait,
+                 max_retries=4, cache_ttl=5, instances=None):
         self.base_url = "https://api.cloudflare.com/client/v4/accounts/" + \
             "{account_id}/load_balancers/pools".format(account_id=account_id)
         self.url = self.base_url + "/{pool_id}".format(pool_id=pool_id)
@@ -130,38 +215,56 @@ class Cloudflare(object):
         self.instance_name = instance_name
         self.instance_weight = instance_weight
         self.wait = wait
+        self.instances = instances
+        self.max_retries = max(1, max_retries)
+        self.cache_ttl = cache_ttl
         self.changed = False
+        self.session = _SESSION
+        self.session.headers.update({
+            'Content-Type': 'application/json',
+            'X-Auth-Email': email,
+            'X-Auth-Key': api_key,
+        })
 
-    def request(self, content, **kwargs):
-        # remove unset
-        kwargs = dict((k, v) for k, v in kwargs.iteritems() if v)
+    def request(self, content):
+        key = self._cache_key()
+        cached = _POOL_CACHE.get(key)
 
-        # Instantiate custom request
-        handler = urllib2.HTTPHandler()
-        opener = urllib2.build_opener(handler)
+        # Revalidate a previously fetched pool instead of downloading it again
+        headers = {}
+        if content is None and cached is not None and cached[1]:
+            headers['If-None-Match'] = cached[1]
 
-        # Is it a get or put request
-        if content is None:
-            request = urllib2.Request(self.base_url)
-            request.get_method = lambda: 'GET'
-        else:
-            request = urllib2.Request(self.url)
-            request.get_method = lambda: 'PUT'
-            request.data = content
+        for attempt in range(self.max_retries):
+            # Is it a get or put request
+            if content is None:
+                response = self.session.get(self.url, headers=headers)
+            else:
+                response = self.session.put(self.url, data=content)
+
+            if not _is_retryable(response) or attempt == self.max_retries - 1:
+                break
+            time.sleep(_retry_delay(response, attempt))
+
+        if not response.ok:
+            raise CloudflareException(_error_message(response))
 
-        # Add headers
-        request.add_header("Content-Type", 'application/json')
-        request.add_header('X-Auth-Email', self.email)
-        request.add_header('X-Auth-Key', self.api_key)
+        # The pool has changed, so any cached copy of it is stale
+        if content is not None:
+            _POOL_CACHE.pop(key, None)
+            return json_loads(response.content)
 
-        connection = opener.open(request)
-        response_json = json.loads(connection.read())
-        return response_json
+        if response.status_code == 304:
+            etag, body = cached[1], cached[2]
+        else:
+            etag, body = None, json_loads(response.content)
+        etag = response.headers.get('ETag', etag)
+        _POOL_CACHE[key] = (time.time() + self.cache_ttl, etag, body)
+        return body
 
 
     def req_present(self):
         current_state = self._req_pool_info()
-        current_pool_name = current_state.get('name')
         origins = current_state.get('origins')
 
         # new origin to be added
@@ -172,37 +275,151 @@ class Cloudflare(object):
             "address": self.instance_ip,
 	    }
 
+        # Nothing to do if the origin is already registered as requested
+        candidates = [origin for origin in origins if origin['address'] == self.instance_ip]
+        if self._origin_matches(candidates, self.instance_name, self.instance_weight):
+            return self._unchanged(current_state)
+
         # Remove existing origin from list if exists
-        desired_origins_state = list(filter(lambda i: i['address'] != self.instance_ip, origins))
+        desired_origins_state = [origin for origin in origins if origin['address'] != self.instance_ip]
         desired_origins_state.append(new_origin)
 
-        # create minimal object that cloudflare api will accept
-        desired_state = json.dumps({
-            "name": current_pool_name,
-            "origins": desired_origins_state,
-        })
+        desired_state = self._desired_pool_state(current_state, desired_origins_state)
 
         self.changed = not self._dict_lists_match(origins, desired_origins_state)
-        return self.request(a='req_present', content=desired_state)
+        resp = self.request(content=desired_state)
+        if self.wait:
+            self._wait_for(lambda by_ip: self._origin_matches(
+                by_ip.get(self.instance_ip, []), self.instance_name, self.instance_weight))
+        return resp
 
 
     def req_absent(self):
         current_state = self._req_pool_info()
-        current_pool_name = current_state.get('name')
         origins = current_state.get('origins')
-        desired_origins_state = list(filter(lambda i: i['address'] != self.instance_ip, origins))
+
+        # Split origins in a single pass, counting the ones being removed
+        matched = 0
+        desired_origins_state = []
+        for origin in origins:
+            if origin['address'] == self.instance_ip:
+                matched += 1
+            else:
+                desired_origins_state.append(origin)
+
+        # Nothing to do if the origin is already gone
+        if matched == 0:
+            return self._unchanged(current_state)
 
         # new origins contains at least one origin
-        if len(desired_origins_state) <= 1:
+        if len(desired_origins_state) < 1:
             raise CloudflareException('Cloudflare requires origin to contain at least one entry')
 
-        desired_state = json.dumps({
-            "name": current_pool_name,
-            "origins": desired_origins_state
-        })
+        desired_state = self._desired_pool_state(current_state, desired_origins_state)
 
         self.changed = not self._dict_lists_match(origins, desired_origins_state)
-        return self.request(a='req_absent', content=desired_state)
+        resp = self.request(content=desired_state)
+        if self.wait:
+            self._wait_for(lambda by_ip: self.instance_ip not in by_ip)
+        return resp
+
+    def req_bulk_present(self):
+        current_state = self._req_pool_info()
+        origins = current_state.get('origins')
+
+        # Requested origins that differ from what the pool has
+        by_ip = self._group_by_ip(origins)
+        new_origins = {}
+        for instance in self.instances:
+            ip, name, weight = instance['ip'], instance['name'], instance['weight']
+            if name is None:
+                raise CloudflareException('Each entry in instances requires name when state is present')
+            if weight is None:
+                weight = self.instance_weight
+            if not self._origin_matches(by_ip.get(ip, []), name, weight):
+                new_origins[ip] = {
+                    "enabled": True,
+                    "name": name,
+                    "weight": weight,
+                    "address": ip,
+                }
+
+        if not new_origins:
+            return self._unchanged(current_state)
+
+        # Replace only the requested addresses, every other origin is kept as is
+        desired_origins_state = [origin for origin in origins if origin['address'] not in new_origins]
+        desired_origins_state.extend(new_origins.values())
+
+        self.changed = True
+        resp = self.request(content=self._desired_pool_state(current_state, desired_origins_state))
+        if self.wait:
+            self._wait_for(lambda by_ip: all(
+                self._origin_matches(by_ip.get(ip, []), origin['name'], origin['weight'])
+                for ip, origin in new_origins.items()))
+        return resp
+
+    def req_bulk_absent(self):
+        current_state = self._req_pool_info()
+        origins = current_state.get('origins')
+
+        ips = set(instance['ip'] for instance in self.instances)
+        desired_origins_state = [origin for origin in origins if origin['address'] not in ips]
+
+        # Nothing to do if all origins are already gone
+        if len(desired_origins_state) == len(origins):
+            return self._unchanged(current_state)
+
+        # new origins contains at least one origin
+        if len(desired_origins_state) < 1:
+            raise CloudflareException('Cloudflare requires origin to contain at least one entry')
+
+        self.changed = True
+        resp = self.request(content=self._desired_pool_state(current_state, desired_origins_state))
+        if self.wait:
+            self._wait_for(lambda by_ip: ips.isdisjoint(by_ip))
+        return resp
+
+    def _unchanged(self, current_state):
+        # Same shape as a PUT response so callers always get the pool back
+        self.changed = False
+        return {'result': current_state}
+
+    def _wait_for(self, satisfied):
+        # Re-read the pool with backoff until satisfied(origins_by_ip) holds.
+        # request() always hits the API here, revalidating against the cached ETag.
+        deadline = time.time() + WAIT_TIMEOUT
+        for delay in WAIT_DELAYS:
+            time.sleep(delay)
+            origins = self.request(content=None).get('result').get('origins')
+            if satisfied(self._group_by_ip(origins)):
+                return
+            if time.time() > deadline:
+                break
+        raise CloudflareException('Timed out waiting for origin propagation')
+
+    def _origin_matches(self, candidates, name, weight):
+        # The write path replaces every origin with the address, so a single
+        # matching origin is the only state that needs no update
+        if len(candidates) != 1:
+            return False
+        origin = candidates[0]
+        return origin.get('name') == name and \
+            float(origin.get('weight', 1)) == float(weight) and \
+            origin.get('enabled', True)
+
+    def _group_by_ip(self, origins):
+        by_ip = {}
+        for origin in origins:
+            by_ip.setdefault(origin['address'], []).append(origin)
+        return by_ip
+
+    def _desired_pool_state(self, current_state, origins):
+        # Echo back every pool setting, a PUT resets omitted fields to their defaults.
+        # current_state may be shared with the pool cache, so it is copied rather than mutated.
+        desired_state = dict((k, v) for k, v in current_state.items() if k not in READ_ONLY_POOL_FIELDS)
+        desired_state['origins'] = origins
+        return json_dumps(desired_state)
 
     def _dict_lists_match(self, xs, ys):
         intersec = [item for item in xs if item in ys]
@@ -234,16 +451,45 @@ class Cloudflare(object):
           'name':'pool_name'
         }
         """
-        pools = self.request(a='_req_pool_info', content=None).get('result')
-        selected_pool = next((item for item in pools if item['id'] == self.pool_id), None)
-        return selected_pool
+        key = self._cache_key()
+        cached = _POOL_CACHE.get(key)
+        if cached is not None and cached[0] > time.time():
+            return cached[2].get('result')
+
+        return self.request(content=None).get('result')
+
 
+    def _cache_key(self):
+        return (self.url, self.api_key)
 
-    def _get_origin_by_ip(self, origins):
-        return next((item for item in origins if item['address'] == self.instance_ip), None)
+
+def _is_retryable(response):
+    return response.status_code == 429 or response.status_code >= 500
+
+
+def _retry_delay(response, attempt):
+    retry_after = response.headers.get('Retry-After')
+    if retry_after is not None:
+        try:
+            return max(0, int(retry_after))
+        except ValueError:
+            pass
+    return min(MAX_RETRY_DELAY, 1.0 * 2 ** attempt * (1 + random.random() * 0.5))
+
+
+def _error_message(response):
+    # Prefer the message from cloudflare's error envelope when there is one
+    try:
+        return json_loads(response.content)['errors'][0]['message']
+    except (ValueError, KeyError, IndexError, TypeError):
+        return 'Cloudflare API returned HTTP {0}'.format(response.status_code)
 
 
 def cloudflare_account_instance(module):
+    state = module.params['state']
+    if state not in ('present', 'absent'):
+        module.fail_json(msg='Unknown value "{0}" for argument state. Expected one of: present, absent.'.format(state))
+
     cloudflare = Cloudflare(module.params['email'],
                             module.params['api_key'],
                             module.params['account_id'],
@@ -252,19 +498,22 @@ def cloudflare_account_instance(module):
                             module.params['instance_ip'],
                             module.params['instance_name'],
                             module.params['instance_weight'],
-                            module.params['wait'],)
-
-    state = module.params['state']
-
-    if state == 'present':
+                            module.params['wait'],
+                            module.params['max_retries'],
+                            module.params['cache_ttl'],
+                            module.params['instances'],)
+
+    if module.params['instances'] is not None:
+        if state == 'present':
+            resp = cloudflare.req_bulk_present()
+        else:
+            resp = cloudflare.req_bulk_absent()
+    elif state == 'present':
         resp = cloudflare.req_present()
-        module.exit_json(changed=cloudflare.changed, origins=resp['result']['origins'])
-
-    elif state == 'absent':
+    else:
         resp = cloudflare.req_absent()
-        module.exit_json(changed=cloudflare.changed, origins=resp['result']['origins'])
 
-    module.fail_json(msg='Unknown value "{0}" for argument state. Expected one of: present, absent.')
+    module.exit_json(changed=cloudflare.changed, origins=resp['result']['origins'])
 
 def main():
     module = AnsibleModule(
@@ -274,14 +523,27 @@ def main():
             email=dict(default=os.environ.get('CLOUDFLARE_API_EMAIL')),
             api_key=dict(no_log=True, default=os.environ.get('CLOUDFLARE_API_TOKEN')),
             state=dict(required=True, choices=['present', 'absent']),
-            instance_ip=dict(required=True),
-            instance_name=dict(required=True),
+            instance_ip=dict(required=False),
+            instance_name=dict(required=False),
             instance_weight=dict(required=False, default=1.0, type=float),
             wait=dict(required=False, default=False, type=bool),
+            max_retries=dict(required=False, default=4, type=int),
+            cache_ttl=dict(required=False, default=5, type=int),
+            instances=dict(required=False, default=None, type='list', elements='dict', options=dict(
+                ip=dict(required=True),
+                name=dict(required=False),
+                weight=dict(required=False, type='float'),
+            )),
         ),
+        required_one_of=[['instance_ip', 'instances']],
+        required_together=[['instance_ip', 'instance_name']],
+        mutually_exclusive=[['instance_ip', 'instances'], ['instance_name', 'instances']],
         supports_check_mode=False,
     )
 
+    if not HAS_REQUESTS:
+        module.fail_json(msg=missing_required_lib('requests'))
+
     try:
         req = cloudflare_account_instance(module)
     except Exception as err:
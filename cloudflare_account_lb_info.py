@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 #
 # This is a free software: you can redistribute it and/or modify
@@ -20,11 +20,31 @@
 # https://api.cloudflare.com/#account-load-balancer-pools-properties
 
 
-import json
-import urllib2
 import os
+import random
+import time
 
-from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.basic import AnsibleModule, missing_required_lib
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+    HAS_REQUESTS = True
+except ImportError:
+    HAS_REQUESTS = False
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    import json
+    json_loads = json.loads
+
+try:
+    import ijson
+    HAS_IJSON = True
+except ImportError:
+    HAS_IJSON = False
 
 
 DOCUMENTATION = '''
@@ -34,6 +54,8 @@ short_description: Gather information about Cloudflare load balancer pools
 description:
   - Gather information about a Cloudflare load balancer pool
 author: Beat beat.no
+requirements:
+  - requests
 options:
   account_id:
     description: Identifier of the load balancer account
@@ -48,6 +70,12 @@ options:
       - The e-mail address associated with the API key.
       - This can also be provided by setting the CLOUDFLARE_API_EMAIL environment variable.
     required: true
+  max_retries:
+    description:
+      - Number of attempts made for a request that is rate limited (429) or hits a transient server error (5xx).
+      - Honors the Retry-After header, otherwise backs off exponentially up to 30 seconds between attempts.
+    required: false
+    default: 4
 '''
 
 EXAMPLES = '''
@@ -105,44 +133,80 @@ clbs:
     }]
 '''
 
+# Shared across Cloudflare instances so consecutive calls reuse one TLS connection
+_SESSION = None
+if HAS_REQUESTS:
+    _SESSION = requests.Session()
+    _SESSION.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=0))
+
+MAX_RETRY_DELAY = 30
+
 class CloudflareException(Exception):
     pass
 
 class Cloudflare(object):
-    def __init__(self, email, api_key, account_id):
+    def __init__(self, email, api_key, account_id, max_retries=4):
         self.url = "https://api.cloudflare.com/client/v4/accounts/" + \
                      "{account_id}/load_balancers/pools".format(account_id=account_id)
         self.email = email
         self.api_key = api_key
+        self.max_retries = max(1, max_retries)
+        self.session = _SESSION
+        self.session.headers.update({
+            'Content-Type': 'application/json',
+            'X-Auth-Email': email,
+            'X-Auth-Key': api_key,
+        })
+
+    def request(self, method):
+        for attempt in range(self.max_retries):
+            response = self.session.request(method, self.url, stream=HAS_IJSON)
+            if not _is_retryable(response) or attempt == self.max_retries - 1:
+                break
+            response.close()
+            time.sleep(_retry_delay(response, attempt))
+
+        if not response.ok:
+            raise CloudflareException(_error_message(response))
+
+        # Only the result list is used, stream it out of the body when ijson is available
+        with response:
+            if HAS_IJSON:
+                response.raw.decode_content = True
+                return list(ijson.items(response.raw, 'result.item', use_float=True))
+            return json_loads(response.content).get('result')
 
-    def request(self, method, **kwargs):
-        # remove unset
-        kwargs = dict((k, v) for k, v in kwargs.iteritems() if v)
+    def rec_info(self):
+        return self.request(method='GET')
 
-        # Instantiate custom request
-        handler = urllib2.HTTPHandler()
-        opener = urllib2.build_opener(handler)
-        request = urllib2.Request(self.url)
 
-        # Add headers
-        request.add_header("Content-Type", 'application/json')
-        request.add_header('X-Auth-Email', self.email)
-        request.add_header('X-Auth-Key', self.api_key)
+def _is_retryable(response):
+    return response.status_code == 429 or response.status_code >= 500
 
-        request.get_method = lambda: method
-        connection = opener.open(request)
-        response_json = json.loads(connection.read())
 
-        return response_json
+def _retry_delay(response, attempt):
+    retry_after = response.headers.get('Retry-After')
+    if retry_after is not None:
+        try:
+            return max(0, int(retry_after))
+        except ValueError:
+            pass
+    return min(MAX_RETRY_DELAY, 1.0 * 2 ** attempt * (1 + random.random() * 0.5))
 
-    def rec_info(self):
-        return self.request(a='rec_info', method='GET')
+
+def _error_message(response):
+    # Prefer the message from cloudflare's error envelope when there is one
+    try:
+        return json_loads(response.content)['errors'][0]['message']
+    except (ValueError, KeyError, IndexError, TypeError):
+        return 'Cloudflare API returned HTTP {0}'.format(response.status_code)
 
 
 def cloudflare_account_lb(module):
     cloudflare = Cloudflare(module.params['email'],
                             module.params['api_key'],
-                            module.params['account_id'])
+                            module.params['account_id'],
+                            module.params['max_retries'])
     return cloudflare.rec_info()
 
 def main():
@@ -151,16 +215,20 @@ def main():
             account_id=dict(no_log=True, required=True),
             email=dict(default=os.environ.get('CLOUDFLARE_API_EMAIL')),
             api_key=dict(no_log=True, default=os.environ.get('CLOUDFLARE_API_TOKEN')),
+            max_retries=dict(required=False, default=4, type=int),
         ),
         supports_check_mode=False,
     )
 
+    if not HAS_REQUESTS:
+        module.fail_json(msg=missing_required_lib('requests'))
+
     try:
         request = cloudflare_account_lb(module)
     except Exception as err:
         module.fail_json(msg=str(err))
 
-    module.exit_json(clbs=request.get('result'))
+    module.exit_json(clbs=request)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,466 @@
+import importlib
+import json
+import sys
+
+import pytest
+import requests
+
+import cloudflare_account_instance as cai
+
+
+POOL_ID = '320fd09sa09fdsa98a09sfd098saf'
+
+
+def make_response(status, body=None, headers=None):
+    response = requests.Response()
+    response.status_code = status
+    response._content = json.dumps(body).encode('utf-8') if body is not None else b''
+    response.headers.update(headers or {})
+    return response
+
+
+def origin(address, name, weight=1.0, **extra):
+    entry = {'enabled': True, 'name': name, 'weight': weight, 'address': address}
+    entry.update(extra)
+    return entry
+
+
+def pool(*origins):
+    return {
+        'success': True,
+        'result': {
+            'id': POOL_ID,
+            'created_on': '1814-05-17T09:46:07.281116Z',
+            'modified_on': '1914-05-17T12:34:31.398522Z',
+            'name': 'pool_name',
+            'monitor': 'monitor_id',
+            'origins': list(origins),
+        },
+    }
+
+
+class FakeSession(object):
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = []
+        self.raw_bodies = []
+
+    def get(self, url, headers=None):
+        self.calls.append(('GET', url, headers))
+        return self.responses.pop(0)
+
+    def put(self, url, data=None):
+        self.raw_bodies.append(data)
+        self.calls.append(('PUT', url, json.loads(data)))
+        return self.responses.pop(0)
+
+    def put_bodies(self):
+        return [call[2] for call in self.calls if call[0] == 'PUT']
+
+
+def make_cloudflare(session, **kwargs):
+    params = dict(
+        email='joe@example.com',
+        api_key='key',
+        account_id='account',
+        pool_id=POOL_ID,
+        state='present',
+        instance_ip='3.3.3.3',
+        instance_name='c',
+        instance_weight=1.0,
+        wait=False,
+    )
+    params.update(kwargs)
+    cloudflare = cai.Cloudflare(**params)
+    cloudflare.session = session
+    return cloudflare
+
+
+def addresses(origins):
+    return [(o['address'], o['name']) for o in origins]
+
+
+@pytest.fixture
+def reload_without(monkeypatch):
+    # Reload the module with the given imports blocked, restoring it afterwards
+    def reload(*names):
+        for name in names:
+            monkeypatch.setitem(sys.modules, name, None)
+        return importlib.reload(cai)
+    yield reload
+    monkeypatch.undo()
+    importlib.reload(cai)
+
+
+@pytest.fixture(autouse=True)
+def clean_cache():
+    cai._POOL_CACHE.clear()
+    yield
+    cai._POOL_CACHE.clear()
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture(autouse=True)
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(cai, 'time', clock)
+    return clock
+
+
+def test_present_keeps_origins_sharing_an_address():
+    current = pool(origin('1.1.1.1', 'a'), origin('1.1.1.1', 'a2'), origin('2.2.2.2', 'b'))
+    desired = pool(origin('1.1.1.1', 'a'), origin('1.1.1.1', 'a2'), origin('2.2.2.2', 'b'),
+                   origin('3.3.3.3', 'c'))
+    session = FakeSession(make_response(200, current), make_response(200, desired))
+    cloudflare = make_cloudflare(session)
+
+    cloudflare.req_present()
+
+    body = session.put_bodies()[0]
+    assert addresses(body['origins']) == [
+        ('1.1.1.1', 'a'), ('1.1.1.1', 'a2'), ('2.2.2.2', 'b'), ('3.3.3.3', 'c')]
+    assert body['monitor'] == 'monitor_id'
+    assert 'id' not in body
+    assert cloudflare.changed
+
+
+@pytest.mark.parametrize('name', ['a', 'a2'])
+def test_present_collapses_origins_sharing_the_requested_address(name):
+    current = pool(origin('1.1.1.1', 'a'), origin('1.1.1.1', 'a2'), origin('2.2.2.2', 'b'))
+    session = FakeSession(make_response(200, current), make_response(200, current))
+    cloudflare = make_cloudflare(session, instance_ip='1.1.1.1', instance_name=name)
+
+    cloudflare.req_present()
+
+    # Never a silent no-op that depends on list order, always one origin left for the address
+    assert addresses(session.put_bodies()[0]['origins']) == [('2.2.2.2', 'b'), ('1.1.1.1', name)]
+    assert cloudflare.changed
+
+
+def test_bulk_present_collapses_origins_sharing_a_requested_address():
+    current = pool(origin('1.1.1.1', 'a'), origin('1.1.1.1', 'a2'), origin('2.2.2.2', 'b'))
+    session = FakeSession(make_response(200, current), make_response(200, current))
+    cloudflare = make_cloudflare(session, instance_ip=None, instance_name=None, instances=[
+        {'ip': '1.1.1.1', 'name': 'a2', 'weight': None},
+    ])
+
+    cloudflare.req_bulk_present()
+
+    assert addresses(session.put_bodies()[0]['origins']) == [('2.2.2.2', 'b'), ('1.1.1.1', 'a2')]
+    assert cloudflare.changed
+
+
+def test_present_replaces_existing_origin_for_ip():
+    current = pool(origin('1.1.1.1', 'a'), origin('3.3.3.3', 'old'))
+    session = FakeSession(make_response(200, current), make_response(200, current))
+    cloudflare = make_cloudflare(session)
+
+    cloudflare.req_present()
+
+    assert addresses(session.put_bodies()[0]['origins']) == [('1.1.1.1', 'a'), ('3.3.3.3', 'c')]
+
+
+def test_bulk_present_keeps_origins_sharing_an_address():
+    current = pool(origin('1.1.1.1', 'a'), origin('1.1.1.1', 'a2'), origin('2.2.2.2', 'b'))
+    session = FakeSession(make_response(200, current), make_response(200, current))
+    cloudflare = make_cloudflare(session, instance_ip=None, instance_name=None, instances=[
+        {'ip': '2.2.2.2', 'name': 'b', 'weight': 0.5},
+        {'ip': '3.3.3.3', 'name': 'c', 'weight': None},
+    ])
+
+    cloudflare.req_bulk_present()
+
+    origins = session.put_bodies()[0]['origins']
+    assert addresses(origins) == [
+        ('1.1.1.1', 'a'), ('1.1.1.1', 'a2'), ('2.2.2.2', 'b'), ('3.3.3.3', 'c')]
+    assert [o['weight'] for o in origins] == [1.0, 1.0, 0.5, 1.0]
+    assert cloudflare.changed
+
+
+def run_module(monkeypatch, capsys, args):
+    module_args = json.dumps({'ANSIBLE_MODULE_ARGS': args}).encode('utf-8')
+    monkeypatch.setattr('ansible.module_utils.basic._ANSIBLE_ARGS', module_args)
+    # Newer ansible-core also needs a serialization profile for the args
+    monkeypatch.setattr('ansible.module_utils.basic._ANSIBLE_PROFILE', 'legacy', raising=False)
+    with pytest.raises(SystemExit):
+        cai.main()
+    return json.loads(capsys.readouterr().out)
+
+
+@pytest.mark.parametrize('instances', [['10.0.0.1'], [{'name': 'c'}]])
+def test_instances_entries_must_be_dicts_with_ip(monkeypatch, capsys, instances):
+    result = run_module(monkeypatch, capsys, {
+        'account_id': 'account',
+        'pool_id': POOL_ID,
+        'email': 'joe@example.com',
+        'api_key': 'key',
+        'state': 'present',
+        'instances': instances,
+    })
+
+    # Rejected by argument validation, before the module touches the API
+    assert result['failed']
+    assert 'has no attribute' not in result['msg']
+
+
+def test_present_is_a_noop_when_origin_matches():
+    current = pool(origin('1.1.1.1', 'a'), origin('3.3.3.3', 'c'))
+    session = FakeSession(make_response(200, current))
+    cloudflare = make_cloudflare(session)
+
+    resp = cloudflare.req_present()
+
+    assert session.put_bodies() == []
+    assert not cloudflare.changed
+    assert resp['result']['origins'] == current['result']['origins']
+
+
+def test_absent_is_a_noop_when_origin_is_missing():
+    current = pool(origin('1.1.1.1', 'a'), origin('2.2.2.2', 'b'))
+    session = FakeSession(make_response(200, current))
+    cloudflare = make_cloudflare(session, state='absent')
+
+    resp = cloudflare.req_absent()
+
+    assert session.put_bodies() == []
+    assert not cloudflare.changed
+    assert resp['result']['origins'] == current['result']['origins']
+
+
+def test_retries_rate_limited_request_after_retry_after(clock):
+    session = FakeSession(
+        make_response(429, {'success': False, 'errors': [{'message': 'rate limited'}]},
+                      headers={'Retry-After': '7'}),
+        make_response(200, pool(origin('1.1.1.1', 'a'))),
+    )
+    cloudflare = make_cloudflare(session)
+
+    resp = cloudflare.request(content=None)
+
+    assert clock.slept == [7]
+    assert addresses(resp['result']['origins']) == [('1.1.1.1', 'a')]
+
+
+def test_raises_envelope_message_when_retries_run_out(clock):
+    error = {'success': False, 'errors': [{'code': 1000, 'message': 'upstream unavailable'}]}
+    session = FakeSession(*[make_response(503, error) for _ in range(3)])
+    cloudflare = make_cloudflare(session, max_retries=3)
+
+    with pytest.raises(cai.CloudflareException, match='upstream unavailable'):
+        cloudflare.request(content=None)
+
+    assert len(session.calls) == 3
+    assert len(clock.slept) == 2
+    assert all(0 < delay <= cai.MAX_RETRY_DELAY for delay in clock.slept)
+
+
+def test_client_error_is_not_retried():
+    error = {'success': False, 'errors': [{'message': 'bad pool'}]}
+    session = FakeSession(make_response(400, error))
+    cloudflare = make_cloudflare(session)
+
+    with pytest.raises(cai.CloudflareException, match='bad pool'):
+        cloudflare.request(content=None)
+
+    assert len(session.calls) == 1
+
+
+def test_fresh_cache_entry_skips_the_request():
+    current = pool(origin('1.1.1.1', 'a'))
+    session = FakeSession(make_response(200, current, headers={'ETag': '"v1"'}))
+    cloudflare = make_cloudflare(session)
+
+    first = cloudflare._req_pool_info()
+    second = cloudflare._req_pool_info()
+
+    assert len(session.calls) == 1
+    assert first == second == current['result']
+
+
+def test_not_modified_reuses_cached_body(clock):
+    current = pool(origin('1.1.1.1', 'a'))
+    session = FakeSession(
+        make_response(200, current, headers={'ETag': '"v1"'}),
+        make_response(304, headers={'ETag': '"v1"'}),
+    )
+    cloudflare = make_cloudflare(session)
+
+    cloudflare._req_pool_info()
+    clock.now += cloudflare.cache_ttl + 1
+    revalidated = cloudflare._req_pool_info()
+
+    assert session.calls[0][2] == {}
+    assert session.calls[1][2] == {'If-None-Match': '"v1"'}
+    assert revalidated == current['result']
+
+
+def test_zero_ttl_always_revalidates():
+    current = pool(origin('1.1.1.1', 'a'))
+    session = FakeSession(
+        make_response(200, current, headers={'ETag': '"v1"'}),
+        make_response(304),
+    )
+    cloudflare = make_cloudflare(session, cache_ttl=0)
+
+    cloudflare._req_pool_info()
+    assert cloudflare._req_pool_info() == current['result']
+    assert session.calls[1][2] == {'If-None-Match': '"v1"'}
+
+
+def test_put_invalidates_cached_pool():
+    current = pool(origin('1.1.1.1', 'a'))
+    updated = pool(origin('1.1.1.1', 'a'), origin('3.3.3.3', 'c'))
+    session = FakeSession(
+        make_response(200, current, headers={'ETag': '"v1"'}),
+        make_response(200, updated),
+        make_response(200, updated, headers={'ETag': '"v2"'}),
+    )
+    cloudflare = make_cloudflare(session)
+
+    cloudflare.req_present()
+    assert cloudflare._cache_key() not in cai._POOL_CACHE
+
+    assert cloudflare._req_pool_info() == updated['result']
+    assert session.calls[2] == ('GET', cloudflare.url, {})
+
+
+def bulk(session, state, instances):
+    return make_cloudflare(session, state=state, instance_ip=None, instance_name=None,
+                           instances=instances)
+
+
+def test_bulk_present_is_a_noop_when_all_match():
+    current = pool(origin('1.1.1.1', 'a'), origin('2.2.2.2', 'b', weight=0.5))
+    session = FakeSession(make_response(200, current))
+    cloudflare = bulk(session, 'present', [
+        {'ip': '1.1.1.1', 'name': 'a', 'weight': None},
+        {'ip': '2.2.2.2', 'name': 'b', 'weight': 0.5},
+    ])
+
+    resp = cloudflare.req_bulk_present()
+
+    assert session.put_bodies() == []
+    assert not cloudflare.changed
+    assert resp['result']['origins'] == current['result']['origins']
+
+
+def test_bulk_present_requires_names():
+    session = FakeSession(make_response(200, pool(origin('1.1.1.1', 'a'))))
+    cloudflare = bulk(session, 'present', [{'ip': '3.3.3.3', 'name': None, 'weight': None}])
+
+    with pytest.raises(cai.CloudflareException, match='requires name'):
+        cloudflare.req_bulk_present()
+
+
+def test_bulk_absent_removes_all_requested_in_one_put():
+    current = pool(origin('1.1.1.1', 'a'), origin('1.1.1.1', 'a2'), origin('2.2.2.2', 'b'),
+                   origin('3.3.3.3', 'c'))
+    session = FakeSession(make_response(200, current), make_response(200, current))
+    cloudflare = bulk(session, 'absent', [
+        {'ip': '1.1.1.1', 'name': None, 'weight': None},
+        {'ip': '9.9.9.9', 'name': None, 'weight': None},
+    ])
+
+    cloudflare.req_bulk_absent()
+
+    assert len(session.put_bodies()) == 1
+    assert addresses(session.put_bodies()[0]['origins']) == [('2.2.2.2', 'b'), ('3.3.3.3', 'c')]
+    assert cloudflare.changed
+
+
+def test_bulk_absent_is_a_noop_when_none_present():
+    current = pool(origin('1.1.1.1', 'a'))
+    session = FakeSession(make_response(200, current))
+    cloudflare = bulk(session, 'absent', [{'ip': '9.9.9.9', 'name': None, 'weight': None}])
+
+    resp = cloudflare.req_bulk_absent()
+
+    assert session.put_bodies() == []
+    assert not cloudflare.changed
+    assert resp['result']['origins'] == current['result']['origins']
+
+
+def test_bulk_absent_keeps_at_least_one_origin():
+    current = pool(origin('1.1.1.1', 'a'), origin('2.2.2.2', 'b'))
+    session = FakeSession(make_response(200, current))
+    cloudflare = bulk(session, 'absent', [
+        {'ip': '1.1.1.1', 'name': None, 'weight': None},
+        {'ip': '2.2.2.2', 'name': None, 'weight': None},
+    ])
+
+    with pytest.raises(cai.CloudflareException, match='at least one entry'):
+        cloudflare.req_bulk_absent()
+    assert session.put_bodies() == []
+
+
+def test_wait_polls_until_origin_is_visible(clock):
+    current = pool(origin('1.1.1.1', 'a'))
+    updated = pool(origin('1.1.1.1', 'a'), origin('3.3.3.3', 'c'))
+    session = FakeSession(
+        make_response(200, current),
+        make_response(200, updated),
+        make_response(200, current, headers={'ETag': '"v1"'}),
+        make_response(200, updated, headers={'ETag': '"v2"'}),
+    )
+    cloudflare = make_cloudflare(session, wait=True)
+
+    cloudflare.req_present()
+
+    assert clock.slept == [0.5, 1]
+    assert session.calls[3][2] == {'If-None-Match': '"v1"'}
+
+
+def test_wait_times_out_when_origin_never_appears(clock):
+    current = pool(origin('1.1.1.1', 'a'))
+    session = FakeSession(*[make_response(200, current) for _ in range(2 + len(cai.WAIT_DELAYS))])
+    cloudflare = make_cloudflare(session, wait=True)
+
+    with pytest.raises(cai.CloudflareException, match='Timed out'):
+        cloudflare.req_present()
+
+    assert clock.slept == list(cai.WAIT_DELAYS)
+    assert sum(clock.slept) > cai.WAIT_TIMEOUT
+
+
+def test_missing_requests_fails_cleanly(monkeypatch, capsys, reload_without):
+    reload_without('requests', 'requests.adapters')
+    assert not cai.HAS_REQUESTS
+
+    result = run_module(monkeypatch, capsys, {
+        'account_id': 'account',
+        'pool_id': POOL_ID,
+        'email': 'joe@example.com',
+        'api_key': 'key',
+        'state': 'present',
+        'instance_ip': '3.3.3.3',
+        'instance_name': 'c',
+    })
+
+    assert result['failed']
+    assert 'requests' in result['msg']
+
+
+def test_put_body_is_compact_bytes_without_orjson(reload_without):
+    reload_without('orjson')
+    current = pool(origin('1.1.1.1', 'a'))
+    session = FakeSession(make_response(200, current), make_response(200, current))
+    cloudflare = make_cloudflare(session)
+
+    cloudflare.req_present()
+
+    body = session.raw_bodies[0]
+    assert isinstance(body, bytes)
+    assert b', ' not in body and b': ' not in body
+    assert addresses(json.loads(body)['origins']) == [('1.1.1.1', 'a'), ('3.3.3.3', 'c')]
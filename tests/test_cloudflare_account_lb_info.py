@@ -0,0 +1,151 @@
+import gzip
+import io
+import json
+
+import pytest
+import requests
+import urllib3
+
+import cloudflare_account_lb_info as lb
+
+
+def make_response(status, body=None, headers=None, gzip_body=False):
+    content = json.dumps(body).encode('utf-8') if body is not None else b''
+    headers = dict(headers or {})
+    if gzip_body:
+        content = gzip.compress(content)
+        headers['Content-Encoding'] = 'gzip'
+
+    response = requests.Response()
+    response.status_code = status
+    response.headers = requests.structures.CaseInsensitiveDict(headers)
+    response.raw = urllib3.HTTPResponse(body=io.BytesIO(content), headers=headers, status=status,
+                                        preload_content=False, decode_content=False)
+    return response
+
+
+def pools(*names):
+    return {
+        'success': True,
+        'errors': [],
+        'messages': [],
+        'result': [{'id': name + '_id', 'name': name, 'origins': []} for name in names],
+        'result_info': {'page': 1, 'count': len(names)},
+    }
+
+
+class FakeSession(object):
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = []
+        self.headers = {}
+
+    def request(self, method, url, stream=False):
+        self.calls.append((method, url, stream))
+        return self.responses.pop(0)
+
+
+def make_cloudflare(session, **kwargs):
+    cloudflare = lb.Cloudflare('joe@example.com', 'key', 'account', **kwargs)
+    cloudflare.session = session
+    return cloudflare
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.slept = []
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+
+
+@pytest.fixture(autouse=True)
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(lb, 'time', clock)
+    return clock
+
+
+def test_retries_rate_limited_request_after_retry_after(clock):
+    session = FakeSession(
+        make_response(429, {'success': False, 'errors': [{'message': 'rate limited'}]},
+                      headers={'Retry-After': '7'}),
+        make_response(200, pools('lb_name')),
+    )
+    cloudflare = make_cloudflare(session)
+
+    result = cloudflare.rec_info()
+
+    assert clock.slept == [7]
+    assert [pool['name'] for pool in result] == ['lb_name']
+    assert len(session.calls) == 2
+
+
+def test_raises_envelope_message_when_retries_run_out(clock):
+    error = {'success': False, 'errors': [{'code': 1000, 'message': 'upstream unavailable'}]}
+    session = FakeSession(*[make_response(502, error) for _ in range(3)])
+    cloudflare = make_cloudflare(session, max_retries=3)
+
+    with pytest.raises(lb.CloudflareException, match='upstream unavailable'):
+        cloudflare.rec_info()
+
+    assert len(session.calls) == 3
+    assert len(clock.slept) == 2
+    assert all(0 < delay <= lb.MAX_RETRY_DELAY for delay in clock.slept)
+
+
+def test_client_error_is_not_retried(clock):
+    error = {'success': False, 'errors': [{'message': 'Authentication error'}]}
+    session = FakeSession(make_response(403, error))
+    cloudflare = make_cloudflare(session)
+
+    with pytest.raises(lb.CloudflareException, match='Authentication error'):
+        cloudflare.rec_info()
+
+    assert len(session.calls) == 1
+    assert clock.slept == []
+
+
+@pytest.mark.parametrize('gzip_body', [False, True])
+def test_streams_result_items_with_ijson(monkeypatch, gzip_body):
+    pytest.importorskip('ijson')
+    monkeypatch.setattr(lb, 'HAS_IJSON', True)
+    body = pools('lb_a', 'lb_b')
+    body['result'][0]['origins'] = [{'address': '1.1.1.1', 'name': 'a', 'weight': 0.5, 'enabled': True}]
+    session = FakeSession(make_response(200, body, gzip_body=gzip_body))
+    cloudflare = make_cloudflare(session)
+
+    result = cloudflare.rec_info()
+
+    assert session.calls == [('GET', cloudflare.url, True)]
+    assert result == body['result']
+    assert isinstance(result[0]['origins'][0]['weight'], float)
+
+
+def test_falls_back_to_parsing_whole_body_without_ijson(monkeypatch):
+    monkeypatch.setattr(lb, 'HAS_IJSON', False)
+    body = pools('lb_a', 'lb_b')
+    session = FakeSession(make_response(200, body, gzip_body=True))
+    cloudflare = make_cloudflare(session)
+
+    result = cloudflare.rec_info()
+
+    assert session.calls == [('GET', cloudflare.url, False)]
+    assert result == body['result']
+
+
+def test_main_exits_with_result_list(monkeypatch, capsys):
+    body = pools('lb_a')
+    monkeypatch.setattr(lb, '_SESSION', FakeSession(make_response(200, body)))
+    args = {'account_id': 'account', 'email': 'joe@example.com', 'api_key': 'key'}
+    module_args = json.dumps({'ANSIBLE_MODULE_ARGS': args}).encode('utf-8')
+    monkeypatch.setattr('ansible.module_utils.basic._ANSIBLE_ARGS', module_args)
+    # Newer ansible-core also needs a serialization profile for the args
+    monkeypatch.setattr('ansible.module_utils.basic._ANSIBLE_PROFILE', 'legacy', raising=False)
+
+    with pytest.raises(SystemExit):
+        lb.main()
+    result = json.loads(capsys.readouterr().out)
+
+    assert not result.get('failed')
+    assert result['clbs'] == body['result']